@@ -1,13 +1,23 @@
 import os
 import json
+import asyncio
 import re
+import hashlib
+import sqlite3
 import time
-from typing import List
+import threading
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from collections import deque
+from itertools import islice
+from typing import Iterable, Iterator, List
+from typing_extensions import TypedDict
 from fastapi import FastAPI, UploadFile, File, Form
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 from sentence_transformers import SentenceTransformer
-from bs4 import BeautifulSoup
+import lxml.etree as ET
 import fitz
 import google.generativeai as genai
 from chromadb import PersistentClient
@@ -19,6 +29,9 @@ GEMINI_KEY = os.getenv("GEMINI_API_KEY", "")
 genai.configure(api_key=GEMINI_KEY)
 
 EMBED_MODEL = "all-MiniLM-L6-v2"
+# Optional int8 ONNX export of EMBED_MODEL (see README); used when present
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", "onnx_minilm")
+ONNX_MODEL_FILE = "model_quantized.onnx"
 CHROMA_PATH = "chroma_db"
 os.makedirs(CHROMA_PATH, exist_ok=True)
 
@@ -26,7 +39,7 @@ os.makedirs(CHROMA_PATH, exist_ok=True)
 DEFAULT_MODELS = ["gemini-1.5-flash", "gemini-1.5-pro", "gemini-pro", "gemini-1.0-pro"]
 
 def get_available_models():
-    """Get list of available Gemini models, excluding experimental ones."""
+    """Get list of available Gemini models, excluding experimental ones (None if the lookup fails)."""
     try:
         available = []
         excluded_keywords = ["exp", "experimental", "2.5", "2.0"]  
@@ -37,236 +50,621 @@ def get_available_models():
                     available.append(model_name)
         return available
     except Exception:
-        return DEFAULT_MODELS  
+        return None
 
-try:
+def select_models():
+    """Preferred models from the live catalog, or None if it could not be read."""
     available_models = get_available_models()
-    if available_models:
-        preferred = [m for m in DEFAULT_MODELS if m in available_models]
-        if preferred:
-            GEMINI_MODELS = preferred
-        else:
-            GEMINI_MODELS = [m for m in available_models if not any(kw in m.lower() for kw in ["exp", "experimental", "2.5", "2.0"])][:3]
-    else:
-        GEMINI_MODELS = DEFAULT_MODELS
-except Exception:
-    GEMINI_MODELS = DEFAULT_MODELS 
-
+    if not available_models:
+        return None
+    preferred = [m for m in DEFAULT_MODELS if m in available_models]
+    if preferred:
+        return preferred
+    return [m for m in available_models if not any(kw in m.lower() for kw in ["exp", "experimental", "2.5", "2.0"])][:3]
+
+# The model catalog rarely changes: the selection is cached on disk for a day
+# so most startups skip the genai.list_models() round-trip entirely
+MODELS_CACHE_PATH = os.path.join(CHROMA_PATH, "models.json")
+MODELS_CACHE_TTL_SECONDS = 24 * 3600
+
+def load_cached_models():
+    """Cached model selection, or None when missing or older than the TTL."""
+    try:
+        if time.time() - os.path.getmtime(MODELS_CACHE_PATH) < MODELS_CACHE_TTL_SECONDS:
+            with open(MODELS_CACHE_PATH) as f:
+                return json.load(f) or None
+    except (OSError, ValueError):
+        pass
+    return None
+
+def refresh_models() -> List[str]:
+    models = select_models()
+    if models is None:
+        # Not cached, so the next startup tries the lookup again
+        return DEFAULT_MODELS
+    try:
+        with open(MODELS_CACHE_PATH, "w") as f:
+            json.dump(models, f)
+    except OSError:
+        pass
+    return models
+
+# On a cache miss the lookup runs in the app lifespan, off the import path;
+# DEFAULT_MODELS stands in until then
+_cached_models = load_cached_models()
+GEMINI_MODELS = _cached_models or DEFAULT_MODELS
 GEMINI_MODEL = GEMINI_MODELS[0]  
 
-MAX_CONTEXT_CHARS_FIRST = 2000
-MAX_CONTEXT_CHARS_RETRY = 1000
-MAX_CONTEXT_CHARS_FINAL = 500
+MAX_CONTEXT_CHARS = 2000
 MAX_HTML_CHARS = 3000
 MAX_LLM_TOKENS = 2000 
+EMBED_BATCH_SIZE = 64  # chunks embedded and stored per build_kb batch
+LLM_TIMEOUT_SECONDS = 90
+LLM_RACE_WIDTH = 2  # models call_llm queries concurrently
+
+# HNSW index settings (only applied when the collection is first created).
+# hnsw:search_ef is the recall/latency knob: raise it for better recall on
+# large KBs instead of asking for a larger top_k.
+HNSW_CONFIG = {
+    "hnsw:space": "cosine",
+    "hnsw:M": 24,
+    "hnsw:construction_ef": 128,
+    "hnsw:search_ef": 100,
+    "hnsw:num_threads": os.cpu_count() or 1,
+}
+
+# PCA dimension reduction for stored vectors (384 -> 128). Only fitted when a
+# fresh collection receives at least PCA_MIN_SAMPLES chunks, so small KBs keep
+# full-width MiniLM vectors.
+PCA_PATH = os.path.join(CHROMA_PATH, "pca.npz")
+PCA_COMPONENTS = 128
+PCA_MIN_SAMPLES = 5000
+
+# Content-hash -> embedding cache shared by every build_kb call, so duplicate
+# and re-uploaded chunks are never embedded twice
+EMBED_CACHE_PATH = os.path.join(CHROMA_PATH, "embed_cache.sqlite")
 
 # INIT
 client = PersistentClient(path=CHROMA_PATH)
-collection = client.get_or_create_collection(name="docs", metadata={"hnsw:space": "cosine"})
-embedder = SentenceTransformer(EMBED_MODEL)
-
-app = FastAPI()
+collection = client.get_or_create_collection(name="docs", metadata=HNSW_CONFIG)
+
+class OnnxEmbedder:
+    """ONNX Runtime drop-in for SentenceTransformer.encode (mean-pool + L2-norm)."""
+
+    def __init__(self, model_dir: str):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.session = ort.InferenceSession(os.path.join(model_dir, ONNX_MODEL_FILE), providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+    def encode(self, sentences, batch_size: int = 32, convert_to_numpy: bool = True, normalize_embeddings: bool = False, show_progress_bar: bool = False):
+        single = isinstance(sentences, str)
+        if single:
+            sentences = [sentences]
+        out = []
+        for i in range(0, len(sentences), batch_size):
+            enc = self.tokenizer(sentences[i:i + batch_size], padding=True, truncation=True, max_length=256, return_tensors="np")
+            feeds = {k: v.astype(np.int64) for k, v in enc.items() if k in self.input_names}
+            hidden = self.session.run(None, feeds)[0]
+            mask = enc["attention_mask"][..., None].astype(np.float32)
+            emb = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            if normalize_embeddings:
+                emb /= np.linalg.norm(emb, axis=1, keepdims=True) + 1e-12
+            out.append(emb.astype(np.float32))
+        embs = np.concatenate(out) if out else np.zeros((0, 0), dtype=np.float32)
+        return embs[0] if single else embs
+
+if os.path.exists(os.path.join(ONNX_MODEL_DIR, ONNX_MODEL_FILE)):
+    embedder = OnnxEmbedder(ONNX_MODEL_DIR)
+    EMBED_CACHE_TAG = b"onnx-int8"
+else:
+    EMBED_CACHE_TAG = b"st"
+    embedder = SentenceTransformer(EMBED_MODEL)
+
+def load_pca():
+    if not os.path.exists(PCA_PATH):
+        return None
+    data = np.load(PCA_PATH)
+    return data["mean"], data["components"]
+
+def _pca_file_mtime():
+    try:
+        return os.path.getmtime(PCA_PATH)
+    except OSError:
+        return None
+
+_pca_mtime = _pca_file_mtime()
+pca = load_pca()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global GEMINI_MODELS, GEMINI_MODEL
+    if _cached_models is None:
+        GEMINI_MODELS = await asyncio.to_thread(refresh_models)
+        GEMINI_MODEL = GEMINI_MODELS[0]
+        _MODELS.update((m, genai.GenerativeModel(m)) for m in GEMINI_MODELS if m not in _MODELS)
+    yield
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
 
 # Utilities
-def read_pdf(raw: bytes) -> str:
+def fit_pca(embs: np.ndarray):
+    """Fit the PCA for this process only; save_pca() persists it once it is in use."""
+    global pca
+    mean = embs.mean(axis=0)
+    _, _, vt = np.linalg.svd(embs - mean, full_matrices=False)
+    pca = mean, vt[:PCA_COMPONENTS]
+    return pca
+
+def save_pca():
+    global _pca_mtime
+    mean, components = pca
+    np.savez(PCA_PATH, mean=mean, components=components)
+    _pca_mtime = _pca_file_mtime()
+
+def drop_pca():
+    global pca
+    pca = None
+
+def current_pca():
+    """The fitted PCA, reloaded whenever pca.npz changes on disk.
+
+    Another process may fit it after this one started; querying with
+    full-width vectors against the reduced collection would then fail.
+    """
+    global pca, _pca_mtime
+    mtime = _pca_file_mtime()
+    if mtime != _pca_mtime:
+        pca, _pca_mtime = load_pca(), mtime
+        _embed_query.cache_clear()
+        _retrieve_cached.cache_clear()
+    return pca
+
+def project(embs: np.ndarray) -> np.ndarray:
+    """Apply the fitted PCA (if any) and re-normalize rows for cosine search."""
+    pca = current_pca()
+    if pca is None:
+        return embs
+    mean, components = pca
+    out = (embs - mean) @ components.T
+    out /= np.linalg.norm(out, axis=-1, keepdims=True) + 1e-12
+    return out.astype(np.float32)
+
+def read_pdf_pages(raw: bytes) -> Iterator[str]:
     doc = fitz.open(stream=raw, filetype="pdf")
-    texts = [p.get_text("text") for p in doc]
-    return "\n".join(texts)
-
-def chunk_text(text: str, size: int = 350, overlap: int = 80) -> List[str]:
-    words = text.split()
-    chunks = []
-    i = 0
-    while i < len(words):
-        chunks.append(" ".join(words[i:i+size]))
-        i += size - overlap
-    return chunks
-
-def embed_texts(texts: List[str]) -> np.ndarray:
-    emb = embedder.encode(texts, convert_to_numpy=True)
+    for page in doc:
+        yield page.get_text("text")
+
+def extract_text(filename: str, raw: bytes) -> Iterable[str]:
+    """Text of an upload as a sequence of pieces (one per page for PDFs)."""
+    ext = filename.lower().split(".")[-1]
+    if ext == "pdf":
+        return read_pdf_pages(raw)
+    if ext == "json":
+        try:
+            return [json.dumps(json.loads(raw), indent=2)]
+        except:
+            pass
+    return [raw.decode("utf-8", errors="ignore")]
+
+def chunk_text(text: Iterable[str], size: int = 350, overlap: int = 80) -> Iterator[str]:
+    """Yield `size`-word windows every `size - overlap` words.
+
+    Accepts a string or a stream of text pieces; only a window's worth of
+    words is buffered at a time.
+    """
+    if isinstance(text, str):
+        text = (text,)
+    step = max(1, size - overlap)
+    buf = deque()
+    for piece in text:
+        buf.extend(piece.split())
+        while len(buf) >= size:
+            yield " ".join(islice(buf, size))
+            for _ in range(min(step, len(buf))):
+                buf.popleft()
+    while buf:
+        yield " ".join(islice(buf, size))
+        for _ in range(min(step, len(buf))):
+            buf.popleft()
+
+def stream_chunk_batches(filename: str, raw: bytes, put, stop: threading.Event):
+    """Worker thread: hand a file's chunks to `put` in EMBED_BATCH_SIZE batches, then None."""
+    chunks = chunk_text(extract_text(filename, raw))
+    start = 0
+    try:
+        while not stop.is_set() and (batch := list(islice(chunks, EMBED_BATCH_SIZE))):
+            put((filename, start, batch))
+            start += len(batch)
+    finally:
+        if not stop.is_set():
+            put(None)
+
+def embed_texts(texts: List[str], batch_size: int = 64) -> np.ndarray:
+    emb = embedder.encode(texts, batch_size=batch_size, convert_to_numpy=True, normalize_embeddings=True, show_progress_bar=False)
     return emb
 
-def cosine_sim(a: np.ndarray, b: np.ndarray) -> float:
-    if np.linalg.norm(a) == 0 or np.linalg.norm(b) == 0:
-        return 0.0
-    return float(np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b)))
+_embed_cache = None
+
+def _embed_cache_db() -> sqlite3.Connection:
+    # Opened on first use, not at import
+    global _embed_cache
+    if _embed_cache is None:
+        _embed_cache = sqlite3.connect(EMBED_CACHE_PATH)
+        _embed_cache.execute("CREATE TABLE IF NOT EXISTS embeddings (hash BLOB PRIMARY KEY, emb BLOB NOT NULL)")
+    return _embed_cache
+
+def embed_chunks(chunks: List[str]) -> np.ndarray:
+    """embed_texts for build_kb: identical chunks are embedded once and cached on disk."""
+    # The tag keeps ONNX and Sentence Transformers vectors apart
+    hashes = [hashlib.blake2b(c.encode(), digest_size=16, person=EMBED_CACHE_TAG).digest() for c in chunks]
+    unique = dict.fromkeys(hashes)
+    db = _embed_cache_db()
+    rows = db.execute(f"SELECT hash, emb FROM embeddings WHERE hash IN ({','.join('?' * len(unique))})", list(unique))
+    for h, emb in rows:
+        unique[h] = np.frombuffer(emb, dtype=np.float32)
+
+    missing = [h for h, emb in unique.items() if emb is None]
+    if missing:
+        text_of = dict(zip(hashes, chunks))
+        embs = np.asarray(embed_texts([text_of[h] for h in missing]), dtype=np.float32)
+        with db:
+            db.executemany("INSERT OR IGNORE INTO embeddings VALUES (?, ?)", [(h, e.tobytes()) for h, e in zip(missing, embs)])
+        unique.update(zip(missing, embs))
+    return np.stack([unique[h] for h in hashes])
+
+# Sentence boundary: whitespace after ., ! or ? (the punctuation stays with the sentence)
+_SENT_SPLIT = re.compile(r'(?<=[.!?])\s+')
+SUMMARY_SCAN_CHARS = 20000
+
+def _pick(sims: np.ndarray, lengths: np.ndarray, max_chars: int) -> np.ndarray:
+    """Greedy pick of the best-ranked sentences that fit in max_chars (joined with " ")."""
+    order = np.argsort(-sims, kind="stable")
+    needed = np.cumsum(lengths[order] + 1) - 1  # joined length after each pick
+    over = np.flatnonzero(needed > max_chars)
+    return order[: over[0] if over.size else order.size]
 
 def extractive_summary(text: str, max_chars: int = 700, sentences_limit: int = 30) -> str:
-    sentences = [s.strip() for s in text.replace("\n", " ").split(". ") if s.strip()]
+    # Only the first sentences_limit sentences are used, so bound the split
+    sentences = [s.strip() for s in _SENT_SPLIT.split(text[:SUMMARY_SCAN_CHARS]) if s.strip()][:sentences_limit]
     if not sentences:
         return text[:max_chars]
-    sentences = sentences[:sentences_limit]
     sent_embs = embed_texts(sentences)
     doc_emb = embed_texts([" ".join(sentences)])[0]
-    sims = [cosine_sim(doc_emb, se) for se in sent_embs]
-    ranked = sorted(zip(sims, sentences), key=lambda x: x[0], reverse=True)
-    out = ""
-    for sim, s in ranked:
-        if len(out) + len(s) + 2 <= max_chars:
-            out += (". " + s) if out else s
-        else:
-            break
+    # embed_texts returns L2-normalized rows, so cosine similarity is a single matmul
+    sims = sent_embs @ doc_emb
+    lengths = np.array([len(s) for s in sentences], dtype=np.int64)
+    out = " ".join(sentences[i] for i in _pick(sims, lengths, max_chars))
     return out + ("..." if len(out) < len(text) else "")
 
 # Gemini safe wrapper with model fallback and retry logic
-def call_llm(prompt: str, max_tokens: int = MAX_LLM_TOKENS, max_retries: int = 3) -> str:
-    safety_settings = [
-        {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-        {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-        {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-        {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
-    ]
-    
+_SAFETY_SETTINGS = [
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
+]
+
+# Response schema for generate_tests (Gemini JSON mode). The SDK only converts
+# builtin generics and typing_extensions TypedDicts (typing's are rejected
+# before Python 3.12), so no typing.List here.
+class TestCase(TypedDict):
+    id: str
+    title: str
+    scenario: str
+    steps: list[str]
+    expected: str
+    based_on: str
+
+TEST_CASES_SCHEMA = list[TestCase]
+
+_RETRY_RE = re.compile(r'retry in ([\d.]+)s')
+_MODELS = {name: genai.GenerativeModel(name) for name in GEMINI_MODELS}
+
+@lru_cache(maxsize=8)
+def _generation_config(max_tokens: int, response_schema=None):
+    if response_schema is None:
+        return genai.types.GenerationConfig(max_output_tokens=max_tokens, temperature=0.1, top_p=0.95)
+    return genai.types.GenerationConfig(
+        max_output_tokens=max_tokens,
+        temperature=0.1,
+        top_p=0.95,
+        response_mime_type="application/json",
+        response_schema=response_schema,
+    )
+
+# gemini-pro / gemini-1.0-pro reject response_mime_type/response_schema with a 400
+_NO_JSON_MODE_PREFIXES = ("gemini-pro", "gemini-1.0")
+
+def _model_config(model_name: str, max_tokens: int, response_schema):
+    if response_schema is not None and model_name.startswith(_NO_JSON_MODE_PREFIXES):
+        response_schema = None
+    return _generation_config(max_tokens, response_schema)
+
+async def _try_model(model_name: str, prompt: str, generation_config, max_retries: int):
+    """Query one model with quota-aware retries.
+
+    Returns (text, last_error); text is None when the caller should move on
+    to another model.
+    """
+    model = _MODELS[model_name]
     last_error = None
-    for model_name in GEMINI_MODELS:
-        for retry in range(max_retries):
-            try:
-                model = genai.GenerativeModel(model_name)
-                
-                response = model.generate_content(
-                    prompt,
-                    generation_config=genai.types.GenerationConfig(
-                        max_output_tokens=max_tokens,
-                        temperature=0.1,
-                        top_p=0.95
-                    ),
-                    safety_settings=safety_settings
-                )
-
-                if getattr(response, "candidates", None) and len(response.candidates) > 0:
-                    cand = response.candidates[0]
-                    finish_reason = getattr(cand, "finish_reason", None)
-                    
-                    # Check for safety blocks
-                    if finish_reason == 2:  # SAFETY
-                        return "GEMINI ERROR: Safety filter blocked."
-                    elif finish_reason == 3:  # RECITATION
-                        return "GEMINI ERROR: Content recitation blocked."
-                    elif finish_reason == 4:  # OTHER
-                        return "GEMINI ERROR: Generation blocked for other reasons."
-                    
-                    if getattr(getattr(cand, "content", None), "parts", None):
-                        text_out = ""
-                        for part in cand.content.parts:
-                            if hasattr(part, "text") and part.text:
-                                text_out += part.text
-                        if text_out.strip():
-                            return text_out.strip()
-
-                if hasattr(response, "text") and response.text:
-                    return response.text.strip()
-
-                return "GEMINI ERROR: Empty response from LLM."
+    for retry in range(max_retries):
+        try:
+            response = await model.generate_content_async(
+                prompt,
+                generation_config=generation_config,
+                safety_settings=_SAFETY_SETTINGS
+            )
+
+            if getattr(response, "candidates", None) and len(response.candidates) > 0:
+                cand = response.candidates[0]
+                finish_reason = getattr(cand, "finish_reason", None)
                 
-            except Exception as e:
-                error_msg = str(e)
-                last_error = error_msg
+                # Check for safety blocks
+                if finish_reason == 2:  # SAFETY
+                    return "GEMINI ERROR: Safety filter blocked.", None
+                elif finish_reason == 3:  # RECITATION
+                    return "GEMINI ERROR: Content recitation blocked.", None
+                elif finish_reason == 4:  # OTHER
+                    return "GEMINI ERROR: Generation blocked for other reasons.", None
                 
-                if "429" in error_msg or "quota" in error_msg.lower() or "rate limit" in error_msg.lower():
-                    retry_delay = 5  
-                    if "retry in" in error_msg.lower():
-                        try:
-                            import re
-                            delay_match = re.search(r'retry in ([\d.]+)s', error_msg.lower())
-                            if delay_match:
-                                retry_delay = float(delay_match.group(1)) + 1  # Add 1 second buffer
-                        except:
-                            pass
-                    
-                    if retry < max_retries - 1:
-                        wait_time = retry_delay * (2 ** retry)
-                        time.sleep(min(wait_time, 60))  
-                        continue  
-                    else:
-                        break
-                
-                if "404" in error_msg or "not found" in error_msg.lower() or "not supported" in error_msg.lower():
-                    break  
+                if getattr(getattr(cand, "content", None), "parts", None):
+                    text_out = ""
+                    for part in cand.content.parts:
+                        if hasattr(part, "text") and part.text:
+                            text_out += part.text
+                    if text_out.strip():
+                        return text_out.strip(), None
+
+            if hasattr(response, "text") and response.text:
+                return response.text.strip(), None
+
+            return "GEMINI ERROR: Empty response from LLM.", None
+            
+        except Exception as e:
+            error_msg = str(e)
+            last_error = error_msg
+            
+            if "429" in error_msg or "quota" in error_msg.lower() or "rate limit" in error_msg.lower():
+                retry_delay = 5  
+                if "retry in" in error_msg.lower():
+                    try:
+                        delay_match = _RETRY_RE.search(error_msg.lower())
+                        if delay_match:
+                            retry_delay = float(delay_match.group(1)) + 1  # Add 1 second buffer
+                    except:
+                        pass
                 
-                if "free_tier" in error_msg.lower() and "limit: 0" in error_msg.lower():
-                    break  
-                return f"GEMINI ERROR: {error_msg}"
-    
+                if retry < max_retries - 1:
+                    wait_time = retry_delay * (2 ** retry)
+                    await asyncio.sleep(min(wait_time, 60))  
+                    continue  
+                else:
+                    break
+            
+            if "404" in error_msg or "not found" in error_msg.lower() or "not supported" in error_msg.lower():
+                break  
+            
+            if "free_tier" in error_msg.lower() and "limit: 0" in error_msg.lower():
+                break  
+            return f"GEMINI ERROR: {error_msg}", error_msg
+    return None, last_error
+
+async def _call_llm(prompt: str, max_tokens: int = MAX_LLM_TOKENS, max_retries: int = 3, response_schema=None) -> str:
+    last_error = None
+    first_failure = None
+
+    # The first LLM_RACE_WIDTH models run concurrently and the first real
+    # answer wins; the remaining models are only tried if all of them fail
+    racing = [asyncio.create_task(_try_model(m, prompt, _model_config(m, max_tokens, response_schema), max_retries)) for m in GEMINI_MODELS[:LLM_RACE_WIDTH]]
+    pending = set(racing)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                text, error = task.result()
+                if text is not None and not text.startswith("GEMINI ERROR"):
+                    return text
+                first_failure = first_failure or text
+                last_error = error or last_error
+    finally:
+        for task in pending:
+            task.cancel()
+
+    for model_name in GEMINI_MODELS[LLM_RACE_WIDTH:]:
+        text, error = await _try_model(model_name, prompt, _model_config(model_name, max_tokens, response_schema), max_retries)
+        if text is not None and not text.startswith("GEMINI ERROR"):
+            return text
+        first_failure = first_failure or text
+        last_error = error or last_error
+
+    if first_failure:
+        return first_failure
     if "429" in str(last_error) or "quota" in str(last_error).lower():
         return f"GEMINI ERROR: Quota exceeded. Please wait a few minutes and try again, or check your API billing/quota settings. Last error: {last_error}"
     return f"GEMINI ERROR: All models failed. Last error: {last_error}"
 
+# Identical prompts issued while a call is already running share its result
+_inflight_llm = {}
+
+async def call_llm(prompt: str, max_tokens: int = MAX_LLM_TOKENS, max_retries: int = 3, response_schema=None) -> str:
+    key = (prompt, max_tokens, response_schema)
+    task = _inflight_llm.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_call_llm(prompt, max_tokens, max_retries, response_schema))
+        _inflight_llm[key] = task
+        task.add_done_callback(lambda _: _inflight_llm.pop(key, None))
+    # shield: one caller timing out must not cancel the call for the others
+    return await asyncio.shield(task)
+
 # BUILD KB
+# One build at a time: whether to fit the PCA depends on the collection being
+# empty, which a concurrent build could change underneath
+_build_kb_lock = asyncio.Lock()
+
 @app.post("/build_kb")
 async def build_kb(files: List[UploadFile] = File(...)):
-    docs, ids, metas, embs = [], [], [], []
-    for f in files:
-        raw = await f.read()
-        ext = f.filename.lower().split(".")[-1]
-        if ext == "pdf":
-            text = read_pdf(raw)
-        elif ext in ("html", "htm"):
-            text = raw.decode("utf-8", errors="ignore")
-        elif ext == "json":
+    async with _build_kb_lock:
+        return await _build_kb(files)
+
+async def _build_kb(files: List[UploadFile]):
+    raws = await asyncio.gather(*(f.read() for f in files))
+    loop = asyncio.get_running_loop()
+
+    # Until a PCA is fitted for a fresh collection, batches are held back so
+    # the first PCA_MIN_SAMPLES embeddings can fit it; then they stream through
+    awaiting_pca = current_pca() is None and collection.count() == 0
+    pending = []
+    stored = 0
+
+    added_ids = []
+
+    def store(docs, ids, metas, embs):
+        collection.add(documents=docs, embeddings=project(embs).astype(np.float32, copy=False).tolist(), metadatas=metas, ids=ids)
+        added_ids.extend(ids)
+
+    # PyMuPDF is not thread-safe, so files are parsed one after another on a
+    # single worker thread. It streams chunk batches through a bounded queue,
+    # so parsing stays a few batches ahead of embedding and no file is held whole.
+    queue = asyncio.Queue(maxsize=2)
+    stop = threading.Event()
+
+    def put(item):
+        asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+    try:
+        with ThreadPoolExecutor(max_workers=1) as ex:
+            producers = [loop.run_in_executor(ex, stream_chunk_batches, f.filename, raw, put, stop) for f, raw in zip(files, raws)]
             try:
-                text = json.dumps(json.loads(raw), indent=2)
-            except:
-                text = raw.decode("utf-8", errors="ignore")
-        else:
-            text = raw.decode("utf-8", errors="ignore")
-        chunks = chunk_text(text)
-        chunk_embs = embed_texts(chunks)
-        for idx, (chunk, emb) in enumerate(zip(chunks, chunk_embs)):
-            docs.append(chunk)
-            embs.append(emb)
-            ids.append(f"{f.filename}_chunk_{idx}")
-            metas.append({"source_document": f.filename, "chunk_index": idx})
-    collection.add(documents=docs, embeddings=[e.tolist() for e in embs], metadatas=metas, ids=ids)
-    return {"status": "success", "stored_chunks": len(docs)}
+                remaining = len(producers)
+                while remaining:
+                    item = await queue.get()
+                    if item is None:
+                        remaining -= 1
+                        continue
+                    filename, start, docs = item
+                    idxs = range(start, start + len(docs))
+                    batch = (
+                        docs,
+                        [f"{filename}_chunk_{idx}" for idx in idxs],
+                        [{"source_document": filename, "chunk_index": idx} for idx in idxs],
+                        embed_chunks(docs),
+                    )
+                    stored += len(docs)
+                    if not awaiting_pca:
+                        store(*batch)
+                        continue
+                    pending.append(batch)
+                    if stored >= PCA_MIN_SAMPLES:
+                        fit_pca(np.concatenate([b[3] for b in pending]))
+                        _embed_query.cache_clear()
+                        awaiting_pca = False
+                        # pca.npz is only written once the projected vectors are in
+                        try:
+                            for b in pending:
+                                store(*b)
+                        except Exception:
+                            drop_pca()
+                            _embed_query.cache_clear()
+                            raise
+                        save_pca()
+                        pending.clear()
+                await asyncio.gather(*producers)  # re-raise parse errors
+            finally:
+                # On failure, free workers blocked on a full queue so the pool can shut down
+                stop.set()
+                while not all(p.done() for p in producers):
+                    while not queue.empty():
+                        queue.get_nowait()
+                    await asyncio.sleep(0.01)
+                # Retrieve every worker's outcome so none is reported as never retrieved
+                await asyncio.gather(*producers, return_exceptions=True)
+
+        # Fewer than PCA_MIN_SAMPLES chunks: keep full-width vectors
+        for b in pending:
+            store(*b)
+    except BaseException:
+        # All-or-nothing like a single add: drop what this build already stored
+        # so a retried upload does not collide with its chunk ids
+        if added_ids:
+            collection.delete(ids=added_ids)
+            _retrieve_cached.cache_clear()
+        raise
+
+    if stored:
+        _retrieve_cached.cache_clear()
+    return {"status": "success", "stored_chunks": stored}
 
 # RETRIEVE helper
+@lru_cache(maxsize=256)
+def _embed_query(query: str) -> np.ndarray:
+    """Normalized (1, dim) float32 query vector, ready to hand to Chroma as-is."""
+    q_emb = embedder.encode(query, convert_to_numpy=True, normalize_embeddings=True, show_progress_bar=False)
+    q_emb = np.ascontiguousarray(project(q_emb).reshape(1, -1), dtype=np.float32)
+    q_emb.setflags(write=False)  # shared through the cache
+    return q_emb
+
+# Cleared by build_kb whenever the collection changes
+@lru_cache(maxsize=256)
+def _retrieve_cached(query: str, top_k: int):
+    results = collection.query(query_embeddings=_embed_query(query), n_results=top_k, include=["documents", "metadatas"])
+    return tuple(results["documents"][0]), tuple(results["metadatas"][0])
+
 def retrieve_for_query(query: str, top_k: int = 3):
-    q_emb = embed_texts([query])[0].tolist()
-    results = collection.query(query_embeddings=[q_emb], n_results=top_k, include=["documents", "metadatas"])
-    docs = results["documents"][0]
-    metas = results["metadatas"][0]
-    return docs, metas
+    current_pca()  # drops the cached query vectors if the PCA changed on disk
+    docs, metas = _retrieve_cached(query, top_k)
+    return list(docs), list(metas)
 
 # GENERATE SCENARIOS (model-safe wording)
 def extract_json_from_text(text: str) -> str:
-    """Extract JSON from text, handling markdown code blocks."""
-    text = text.strip()
-    
-    json_match = re.search(r'```(?:json)?\s*(\[.*?\]|\{.*?\})\s*```', text, re.DOTALL)
-    if json_match:
-        return json_match.group(1)
-    
-    json_match = re.search(r'(\[.*?\]|\{.*?\})', text, re.DOTALL)
-    if json_match:
-        return json_match.group(1)
-    
-    return text
+    """Extract the first balanced JSON array/object from text (markdown fences included).
 
-@app.post("/generate_tests")
-async def generate_tests(user_prompt: str = Form(...), top_k: int = Form(3)):
-    top_k = min(max(1, int(top_k)), 8)
-
-    docs, metas = retrieve_for_query(user_prompt, top_k=top_k)
-
-    aggregated = ""
-    for d, m in zip(docs, metas):
-        aggregated += f"### Source: {m.get('source_document','unknown')}\n{d}\n\n"
-
-    attempts = [
-        {"max_chars": MAX_CONTEXT_CHARS_FIRST},
-        {"max_chars": MAX_CONTEXT_CHARS_RETRY},
-        {"max_chars": MAX_CONTEXT_CHARS_FINAL},
-    ]
-
-    last_error = None
-    for attempt in attempts:
-        ctx = aggregated[: attempt["max_chars"]]
-        if len(ctx.strip()) < 20:
-            ctx = extractive_summary(aggregated, max_chars=attempt["max_chars"])
+    Single linear scan tracking bracket depth; brackets inside string
+    literals are skipped.
+    """
+    text = text.strip()
 
-        # SAFE prompt: clear and structured
-        prompt = f"""You are a test case generator. Based on the reference documentation below, generate test cases as a JSON array.
+    starts = [i for i in (text.find("["), text.find("{")) if i >= 0]
+    if not starts:
+        return text
+    start = min(starts)
+    open_c = text[start]
+    close_c = "]" if open_c == "[" else "}"
+
+    depth = 0
+    in_string = False
+    escaped = False
+    for j in range(start, len(text)):
+        c = text[j]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif c == "\\":
+                escaped = True
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            in_string = True
+        elif c == open_c:
+            depth += 1
+        elif c == close_c:
+            depth -= 1
+            if depth == 0:
+                return text[start:j + 1]
+
+    return text[start:]
+
+async def run_test_generation(user_prompt: str, aggregated: str) -> dict:
+    ctx = aggregated[:MAX_CONTEXT_CHARS]
+    if len(ctx.strip()) < 20:
+        ctx = extractive_summary(aggregated, max_chars=MAX_CONTEXT_CHARS)
+
+    # SAFE prompt: clear and structured
+    prompt = f"""You are a test case generator. Based on the reference documentation below, generate test cases as a JSON array.
 
 Reference Documentation:
 {ctx}
@@ -301,75 +699,72 @@ Example format:
 
 Now generate the test cases:"""
 
-        llm_out = call_llm(prompt, max_tokens=MAX_LLM_TOKENS)
-        if llm_out.startswith("GEMINI ERROR"):
-            last_error = llm_out
-            if "quota" in llm_out.lower() or "429" in llm_out:
-                break
-            continue
+    # JSON mode: the API constrains output to TEST_CASES_SCHEMA, so no re-prompting on parse errors.
+    # Models without JSON mode get the plain config and are parsed leniently below.
+    llm_out = await call_llm(prompt, max_tokens=MAX_LLM_TOKENS, response_schema=TEST_CASES_SCHEMA)
+    if llm_out.startswith("GEMINI ERROR"):
+        return {"llm": llm_out, "error": "LLM call failed. Try simplifying your request or reduce retrieval depth."}
 
+    try:
+        parsed = json.loads(llm_out)
+    except json.JSONDecodeError:
+        # Answer from a model without JSON mode: may wrap the array in prose or fences
         try:
-            json_text = extract_json_from_text(llm_out)
-            parsed = json.loads(json_text)
-            if isinstance(parsed, list) and len(parsed) > 0:
-                return {"llm": json.dumps(parsed, indent=2), "parsed": parsed, "parsed_count": len(parsed)}
-            else:
-                return {"llm": llm_out, "error": "JSON array is empty or invalid."}
+            parsed = json.loads(extract_json_from_text(llm_out))
         except json.JSONDecodeError as e:
-            if attempt == attempts[-1]:
-                return {"llm": llm_out, "error": f"Could not parse JSON: {str(e)}"}
-            continue
+            return {"llm": llm_out, "error": f"Could not parse JSON: {str(e)}"}
+    if isinstance(parsed, list) and len(parsed) > 0:
+        return {"llm": json.dumps(parsed, indent=2), "parsed": parsed, "parsed_count": len(parsed)}
+    return {"llm": llm_out, "error": "JSON array is empty or invalid."}
 
-    err_msg = last_error or "Unknown LLM failure"
-    return {"llm": err_msg, "error": "All attempts failed. Try simplifying your request or reduce retrieval depth."}
+@app.post("/generate_tests")
+async def generate_tests(user_prompt: str = Form(...), top_k: int = Form(3)):
+    top_k = min(max(1, int(top_k)), 8)
+
+    docs, metas = retrieve_for_query(user_prompt, top_k=top_k)
+
+    aggregated = ""
+    for d, m in zip(docs, metas):
+        aggregated += f"### Source: {m.get('source_document','unknown')}\n{d}\n\n"
+
+    try:
+        return await asyncio.wait_for(run_test_generation(user_prompt, aggregated), timeout=LLM_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        return {"llm": "GEMINI ERROR: Timed out waiting for the LLM.", "error": f"No response within {LLM_TIMEOUT_SECONDS}s. Try again or reduce retrieval depth."}
 
 # GENERATE SELENIUM (robust)
+_HTML_PARSER = ET.HTMLParser(encoding="utf-8")
+
+def _selector_candidates(nodes):
+    """Yield (selector, type, tag, text) for every id/name/class on the given nodes."""
+    for node in nodes:
+        a = node.attrib
+        tag = node.tag
+        text = "".join(t.strip() for t in node.itertext())[:50]
+        if a.get("id"):
+            yield f"#{a['id']}", "id", tag, text
+        if a.get("name"):
+            yield f"[name='{a['name']}']", "name", tag, text
+        for cls in a.get("class", "").split():
+            yield f".{cls}", "class", tag, text
+
 @app.post("/generate_selenium")
 async def generate_selenium(test_case_json: str = Form(...), checkout_html: UploadFile = File(...)):
     try:
         raw_html = (await checkout_html.read()).decode("utf-8", errors="ignore")
         raw_html = raw_html[:MAX_HTML_CHARS]
 
-        soup = BeautifulSoup(raw_html, "lxml")
-        selectors = []
-        seen_selectors = set()
-        
-        for tag in soup.find_all(True):
-            if tag.get("id"):
-                sel = f"#{tag.get('id')}"
-                if sel not in seen_selectors:
-                    selectors.append({
-                        "selector": sel,
-                        "type": "id",
-                        "tag": tag.name,
-                        "text": tag.get_text(strip=True)[:50] if tag.get_text(strip=True) else ""
-                    })
-                    seen_selectors.add(sel)
-            
-            if tag.get("name"):
-                sel = f"[name='{tag.get('name')}']"
-                if sel not in seen_selectors:
-                    selectors.append({
-                        "selector": sel,
-                        "type": "name",
-                        "tag": tag.name,
-                        "text": tag.get_text(strip=True)[:50] if tag.get_text(strip=True) else ""
-                    })
-                    seen_selectors.add(sel)
-            
-            if tag.get("class"):
-                for cls in tag.get("class"):
-                    sel = f".{cls}"
-                    if sel not in seen_selectors:
-                        selectors.append({
-                            "selector": sel,
-                            "type": "class",
-                            "tag": tag.name,
-                            "text": tag.get_text(strip=True)[:50] if tag.get_text(strip=True) else ""
-                        })
-                        seen_selectors.add(sel)
-        
-        selectors = selectors[:150]
+        # lxml refuses str input carrying an <?xml encoding=...?> declaration, so
+        # parse bytes, decoded as UTF-8 like raw_html regardless of the declaration
+        root = ET.HTML(raw_html.encode("utf-8"), _HTML_PARSER) if raw_html.strip() else None
+        nodes = root.xpath("//*[@id or @name or @class]") if root is not None else []
+        # First occurrence of each selector wins; stop once 150 are collected
+        unique = {}
+        for sel, sel_type, tag, text in _selector_candidates(nodes):
+            unique.setdefault(sel, {"selector": sel, "type": sel_type, "tag": tag, "text": text})
+            if len(unique) >= 150:
+                break
+        selectors = list(unique.values())
 
         try:
             docs, metas = retrieve_for_query(test_case_json, top_k=2)
@@ -433,10 +828,9 @@ SCRIPT STRUCTURE:
 
 Generate the complete Selenium Python script now:"""
 
-        llm_out = call_llm(prompt, max_tokens=MAX_LLM_TOKENS)
+        llm_out = await call_llm(prompt, max_tokens=MAX_LLM_TOKENS)
         
         if "```python" in llm_out or "```" in llm_out:
-            import re
             code_match = re.search(r'```(?:python)?\s*(.*?)```', llm_out, re.DOTALL)
             if code_match:
                 llm_out = code_match.group(1).strip()